@@ -1,133 +1,775 @@
 import os
+import time
+import random
+import hashlib
+import itertools
+import asyncio
 import logging
+from collections import OrderedDict
 from fastapi import FastAPI
-from azure.identity import DefaultAzureCredential, get_bearer_token_provider
-from azure.storage.blob import BlobServiceClient
-from langchain_openai import AzureChatOpenAI
+from fastapi.middleware.gzip import GZipMiddleware
+from fastapi.responses import ORJSONResponse, StreamingResponse
+from starlette.background import BackgroundTask
+from starlette.datastructures import Headers
+from starlette.middleware.gzip import GZipResponder
+from pydantic import BaseModel, Field, model_validator
+from pydantic_settings import BaseSettings, SettingsConfigDict
+from openai import APIConnectionError, APITimeoutError, InternalServerError, RateLimitError
+from tenacity import retry, retry_if_exception_type, stop_after_attempt, wait_exponential
+from azure.core import MatchConditions
+from azure.core.exceptions import HttpResponseError
+import azure.identity
+import azure.identity.aio
+from azure.identity import get_bearer_token_provider
+from azure.storage.blob.aio import BlobServiceClient
+import tiktoken
+from langchain_openai import AzureChatOpenAI, AzureOpenAIEmbeddings
+from langchain_core.vectorstores import InMemoryVectorStore
+from langchain_text_splitters import RecursiveCharacterTextSplitter
 from langchain_core.prompts import ChatPromptTemplate
 from langchain_core.output_parsers import StrOutputParser
 
+# Configuration: read and validated once at startup, so a missing variable
+# stops the app immediately instead of failing inside a request
+class Settings(BaseSettings):
+    model_config = SettingsConfigDict(env_file=".env", env_ignore_empty=True, extra="ignore")
+
+    # Toggle between Managed Identity and Connection String / API Key
+    USE_MANAGED_IDENTITY: bool = True
+
+    # Azure Storage
+    STORAGE_ACCOUNT_URL: str | None = None
+    STORAGE_CONNECTION_STRING: str | None = None
+
+    # Azure OpenAI
+    AZURE_OPENAI_ENDPOINT: str
+    AZURE_OPENAI_DEPLOYMENT_NAME: str
+    AZURE_OPENAI_API_KEY: str | None = None
+    AZURE_OPENAI_EMBEDDING_DEPLOYMENT: str | None = None
+    # Optional second deployment (e.g. another region) to share the load with
+    AZURE_OPENAI_SECONDARY_ENDPOINT: str | None = None
+    AZURE_OPENAI_SECONDARY_DEPLOYMENT_NAME: str | None = None  # defaults to the primary name
+    AZURE_OPENAI_SECONDARY_API_KEY: str | None = None
+
+    # Tuning
+    LOG_LEVEL: str = "INFO"
+    CONTEXT_CACHE_TTL_SECONDS: int = 300     # reuse knowledge.txt before re-checking its ETag
+    RESPONSE_CACHE_SIZE: int = 1024          # cached answers; 0 disables the cache
+    PRIME_PROMPT_CACHE: bool = False         # warm Azure OpenAI's prompt cache per new ETag
+    PROMPT_AUDIT_SAMPLE_RATE: float = 0.0    # fraction of prompts logged in full at INFO
+    LLM_CONCURRENCY: int = 10                # concurrent LLM calls per deployment
+    BATCH_CONCURRENCY: int = 10              # concurrent LLM calls per /ask_batch request
+    RETRIEVAL_MIN_TOKENS: int = 8000         # context size that switches on retrieval
+    RETRIEVAL_TOP_K: int = 4                 # chunks sent per question when retrieving
+
+    @model_validator(mode="after")
+    def check_auth_settings(self):
+        if self.USE_MANAGED_IDENTITY:
+            required = ["STORAGE_ACCOUNT_URL"]
+        else:
+            required = ["STORAGE_CONNECTION_STRING", "AZURE_OPENAI_API_KEY"]
+            if self.AZURE_OPENAI_SECONDARY_ENDPOINT:
+                required.append("AZURE_OPENAI_SECONDARY_API_KEY")
+        missing = [name for name in required if not getattr(self, name)]
+        if missing:
+            raise ValueError(
+                f"Missing required settings for USE_MANAGED_IDENTITY={self.USE_MANAGED_IDENTITY}: "
+                + ", ".join(missing)
+            )
+        return self
+
+settings = Settings()
+
 # Configure logging
 logging.basicConfig(
-    level=logging.INFO,
+    level=settings.LOG_LEVEL.upper(),
     format='%(asctime)s - %(name)s - %(levelname)s - %(message)s'
 )
 logger = logging.getLogger(__name__)
 
-app = FastAPI(title="Pro-Grade Identity AI Agent")
+# orjson serializes the (often multi-KB) answer strings much faster than json
+app = FastAPI(title="Pro-Grade Identity AI Agent", default_response_class=ORJSONResponse)
+
+class _NonStreamingGZipResponder(GZipResponder):
+    """Sends ``text/event-stream`` responses uncompressed, so streamed tokens
+    aren't held back in the compressor's buffer."""
 
-# Configuration: Toggle between Managed Identity and Connection String
-USE_MANAGED_IDENTITY = os.getenv("USE_MANAGED_IDENTITY", "true").lower() == "true"
-logger.info(f"🔧 Configuration: USE_MANAGED_IDENTITY={USE_MANAGED_IDENTITY}")
+    passthrough = False
+
+    async def send_with_gzip(self, message):
+        if message["type"] == "http.response.start":
+            content_type = Headers(raw=message["headers"]).get("content-type", "")
+            self.passthrough = content_type.startswith("text/event-stream")
+        if self.passthrough:
+            await self.send(message)
+            return
+        await super().send_with_gzip(message)
+
+class _NonStreamingGZipMiddleware(GZipMiddleware):
+    """GZip for regular responses; event streams are passed through untouched."""
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] == "http" and "gzip" in Headers(scope=scope).get("accept-encoding", ""):
+            responder = _NonStreamingGZipResponder(
+                self.app, self.minimum_size, compresslevel=self.compresslevel
+            )
+            await responder(scope, receive, send)
+            return
+        await self.app(scope, receive, send)
+
+# Level 4 is the bandwidth/CPU sweet spot for short text answers
+app.add_middleware(_NonStreamingGZipMiddleware, minimum_size=1024, compresslevel=4)
+
+logger.info("🔧 Configuration: USE_MANAGED_IDENTITY=%s", settings.USE_MANAGED_IDENTITY)
 
 # 1. Identity Setup
-credential = DefaultAzureCredential() if USE_MANAGED_IDENTITY else None
-if USE_MANAGED_IDENTITY:
-    logger.info("✅ DefaultAzureCredential initialized for Managed Identity authentication")
+def _build_credential(identity):
+    """Picks the most specific credential for where the app is running.
 
-def get_context_from_blob():
-    """Fetches private data from Azure Blob with or without managed identity."""
-    logger.info("📦 Starting blob storage access...")
-    
-    if USE_MANAGED_IDENTITY:
-        # Using Managed Identity (passwordless)
-        blob_url = os.getenv("STORAGE_ACCOUNT_URL")
-        logger.info(f"🔐 Using Managed Identity to access storage: {blob_url}")
-        blob_service = BlobServiceClient(account_url=blob_url, credential=credential)
-    else:
-        # Using Connection String (with secrets)
-        connection_string = os.getenv("STORAGE_CONNECTION_STRING")
-        logger.info(f"🔑 Using Connection String to access storage")
-        blob_service = BlobServiceClient.from_connection_string(connection_string)
-    
-    # Using a simple file read for the 1-hour demo
-    container_name = "docs"
-    blob_name = "knowledge.txt"
-    logger.info(f"📂 Accessing container: '{container_name}', blob: '{blob_name}'")
-    
-    blob_client = blob_service.get_container_client(container_name).get_blob_client(blob_name)
-    
-    logger.info("⬇️ Downloading blob content...")
-    blob_data = blob_client.download_blob().readall().decode('utf-8')
-    logger.info(f"✅ Successfully downloaded blob. Size: {len(blob_data)} characters")
-    logger.debug(f"📄 Blob content preview: {blob_data[:200]}...")
-    
-    return blob_data
+    AKS workload identity injects AZURE_FEDERATED_TOKEN_FILE and App Service /
+    Container Apps inject IDENTITY_ENDPOINT; using the matching credential
+    directly skips DefaultAzureCredential's probing chain. Anywhere else
+    (e.g. local `az login`) falls back to the full chain.
+    """
+    if os.getenv("AZURE_FEDERATED_TOKEN_FILE"):
+        return identity.WorkloadIdentityCredential()
+    if os.getenv("IDENTITY_ENDPOINT"):
+        return identity.ManagedIdentityCredential(client_id=os.getenv("AZURE_CLIENT_ID"))
+    return identity.DefaultAzureCredential()
 
-@app.get("/ask")
-async def ask_langchain(question: str):
-    logger.info(f"🎯 Received question: '{question}'")
-    
-    # 2. Initialize LangChain with Managed Identity or API Key
-    if USE_MANAGED_IDENTITY:
-        # Using Managed Identity (passwordless)
-        logger.info("🔐 Initializing Azure OpenAI with Managed Identity...")
-        # Create a token provider function that returns tokens on-demand
-        token_provider = get_bearer_token_provider(
-            credential,
-            "https://cognitiveservices.azure.com/.default"
-        )
-        logger.info("✅ Token provider created successfully")
-        
-        deployment = os.getenv("AZURE_OPENAI_DEPLOYMENT_NAME")
-        endpoint = os.getenv("AZURE_OPENAI_ENDPOINT")
-        logger.info(f"🤖 Azure OpenAI Config - Endpoint: {endpoint}, Deployment: {deployment}")
-        
-        llm = AzureChatOpenAI(
+credential = _build_credential(azure.identity) if settings.USE_MANAGED_IDENTITY else None
+# The async blob client needs an async credential of its own
+async_credential = _build_credential(azure.identity.aio) if settings.USE_MANAGED_IDENTITY else None
+if settings.USE_MANAGED_IDENTITY:
+    logger.info("✅ %s initialized for Managed Identity authentication", type(credential).__name__)
+
+# 2. LangChain Setup: token provider, LLMs, prompt and chains are built once
+# and shared by every request (each OpenAI client keeps its own connection pool)
+if settings.USE_MANAGED_IDENTITY:
+    # Using Managed Identity (passwordless)
+    logger.info("🔐 Initializing Azure OpenAI with Managed Identity...")
+    # Create the token provider once: it returns cached tokens on demand and
+    # only goes back to Entra ID when the current token is about to expire
+    TOKEN_PROVIDER = get_bearer_token_provider(
+        credential,
+        "https://cognitiveservices.azure.com/.default"
+    )
+    # The async OpenAI client awaits this one, so token refreshes never block
+    # the event loop; the sync provider is still required to build the client
+    ASYNC_TOKEN_PROVIDER = azure.identity.aio.get_bearer_token_provider(
+        async_credential,
+        "https://cognitiveservices.azure.com/.default"
+    )
+    logger.info("✅ Token provider created successfully")
+    AUTH_METHOD = "Managed Identity"
+else:
+    # Using API Key (with secrets)
+    logger.info("🔑 Initializing Azure OpenAI with API Key...")
+    TOKEN_PROVIDER = None
+    ASYNC_TOKEN_PROVIDER = None
+    AUTH_METHOD = "API Key"
+
+def _build_llm(endpoint, deployment, api_key):
+    logger.info("🤖 Azure OpenAI Config - Endpoint: %s, Deployment: %s", endpoint, deployment)
+    # SDK retries are disabled: they would run while holding the concurrency
+    # slot and stack under our own retry, which is the only retry layer
+    if settings.USE_MANAGED_IDENTITY:
+        return AzureChatOpenAI(
             azure_deployment=deployment,
             azure_endpoint=endpoint,
             openai_api_version="2024-02-15-preview",
-            azure_ad_token_provider=token_provider
+            azure_ad_token_provider=TOKEN_PROVIDER,
+            azure_ad_async_token_provider=ASYNC_TOKEN_PROVIDER,
+            max_retries=0
+        )
+    return AzureChatOpenAI(
+        azure_deployment=deployment,
+        azure_endpoint=endpoint,
+        openai_api_version="2024-02-15-preview",
+        openai_api_key=api_key,
+        max_retries=0
+    )
+
+LLMS = [
+    _build_llm(
+        settings.AZURE_OPENAI_ENDPOINT,
+        settings.AZURE_OPENAI_DEPLOYMENT_NAME,
+        settings.AZURE_OPENAI_API_KEY
+    )
+]
+if settings.AZURE_OPENAI_SECONDARY_ENDPOINT:
+    LLMS.append(_build_llm(
+        settings.AZURE_OPENAI_SECONDARY_ENDPOINT,
+        settings.AZURE_OPENAI_SECONDARY_DEPLOYMENT_NAME or settings.AZURE_OPENAI_DEPLOYMENT_NAME,
+        settings.AZURE_OPENAI_SECONDARY_API_KEY
+    ))
+
+logger.info("✅ %d LLM deployment(s) initialized with %s", len(LLMS), AUTH_METHOD)
+
+# Optional embeddings deployment used to retrieve only the relevant parts of
+# a large knowledge.txt instead of sending all of it with every question
+EMBEDDINGS = None
+if settings.AZURE_OPENAI_EMBEDDING_DEPLOYMENT:
+    if settings.USE_MANAGED_IDENTITY:
+        EMBEDDINGS = AzureOpenAIEmbeddings(
+            azure_deployment=settings.AZURE_OPENAI_EMBEDDING_DEPLOYMENT,
+            azure_endpoint=settings.AZURE_OPENAI_ENDPOINT,
+            openai_api_version="2024-02-15-preview",
+            azure_ad_token_provider=TOKEN_PROVIDER,
+            azure_ad_async_token_provider=ASYNC_TOKEN_PROVIDER
         )
-        auth_method = "Managed Identity"
     else:
-        # Using API Key (with secrets)
-        logger.info("🔑 Initializing Azure OpenAI with API Key...")
-        deployment = os.getenv("AZURE_OPENAI_DEPLOYMENT_NAME")
-        endpoint = os.getenv("AZURE_OPENAI_ENDPOINT")
-        logger.info(f"🤖 Azure OpenAI Config - Endpoint: {endpoint}, Deployment: {deployment}")
-        
-        llm = AzureChatOpenAI(
-            azure_deployment=deployment,
-            azure_endpoint=endpoint,
+        EMBEDDINGS = AzureOpenAIEmbeddings(
+            azure_deployment=settings.AZURE_OPENAI_EMBEDDING_DEPLOYMENT,
+            azure_endpoint=settings.AZURE_OPENAI_ENDPOINT,
             openai_api_version="2024-02-15-preview",
-            openai_api_key=os.getenv("AZURE_OPENAI_API_KEY")
+            openai_api_key=settings.AZURE_OPENAI_API_KEY
         )
-        auth_method = "API Key"
+    logger.info(
+        "✅ Embeddings initialized with deployment %s", settings.AZURE_OPENAI_EMBEDDING_DEPLOYMENT
+    )
 
-    logger.info(f"✅ LLM initialized with {auth_method}")
+# The context lives in a byte-identical system message and the question in a
+# separate human message, so every call against the same knowledge.txt shares
+# a stable prefix that Azure OpenAI's automatic prompt caching can reuse
+PROMPT = ChatPromptTemplate.from_messages([
+    ("system", "Answer the question based only on the following context:\n{context}"),
+    ("human", "{question}"),
+])
 
-    # 3. The RAG Chain
-    logger.info("🔄 Fetching context from blob storage...")
-    context = get_context_from_blob()
-    logger.info(f"✅ Context retrieved. Length: {len(context)} characters")
-    
-    logger.info("📝 Building prompt template...")
-    prompt = ChatPromptTemplate.from_template("""
-    Answer the question based only on the following context:
-    {context}
+# One chain per deployment, each with its own concurrency cap. The semaphores
+# are per worker process, so a deployment sees at most
+# workers x LLM_CONCURRENCY in-flight calls
+LLM_BACKENDS = [
+    {
+        "chain": PROMPT | llm | StrOutputParser(),
+        "semaphore": asyncio.Semaphore(settings.LLM_CONCURRENCY),
+    }
+    for llm in LLMS
+]
+_backend_counter = itertools.count()
+logger.info("✅ LangChain pipeline assembled")
+
+def _next_backend():
+    """Round-robins across deployments, skipping any that is already at its cap."""
+    start = next(_backend_counter)
+    for offset in range(len(LLM_BACKENDS)):
+        backend = LLM_BACKENDS[(start + offset) % len(LLM_BACKENDS)]
+        if not backend["semaphore"].locked():
+            return backend
+    return LLM_BACKENDS[start % len(LLM_BACKENDS)]
+
+# 3. Storage Setup: the client is created once at startup so its aiohttp
+# connection pool is reused by every request
+CONTAINER_NAME = "docs"
+BLOB_NAME = "knowledge.txt"
+BLOB_SERVICE = None
+# Download tuning: fetch blobs up to 64 MiB in a single GET (no extra
+# properties/chunk round-trip); anything larger is pulled in 16 MiB chunks
+# over several parallel connections instead of the SDK's 4 MiB serial default
+BLOB_CLIENT_OPTIONS = {
+    "max_single_get_size": 64 * 1024 * 1024,
+    "max_chunk_get_size": 16 * 1024 * 1024,
+}
+BLOB_DOWNLOAD_CONCURRENCY = 8
+# Keep strong references so fire-and-forget tasks aren't garbage collected
+_background_tasks = set()
+
+def _spawn(coro):
+    task = asyncio.create_task(coro)
+    _background_tasks.add(task)
+    task.add_done_callback(_background_tasks.discard)
+
+@app.on_event("startup")
+async def open_blob_service():
+    global BLOB_SERVICE
+    logger.info("📦 Initializing blob storage client...")
     
-    Question: {question}
-    """)
-
-    # Format the complete prompt before sending
-    formatted_prompt = prompt.format(context=context, question=question)
-    logger.info("=" * 80)
-    logger.info("📤 COMPLETE PROMPT BEING SENT TO AZURE OPENAI:")
-    logger.info("=" * 80)
-    logger.info(formatted_prompt)
-    logger.info("=" * 80)
-
-    chain = prompt | llm | StrOutputParser()
-    logger.info("✅ LangChain pipeline assembled")
-
-    # 4. Execute
-    logger.info("🚀 Sending request to Azure OpenAI...")
-    answer = await chain.ainvoke({"context": context, "question": question})
-    logger.info(f"✅ Received response from Azure OpenAI. Answer length: {len(answer)} characters")
-    logger.debug(f"📄 Answer preview: {answer[:200]}...")
+    if settings.USE_MANAGED_IDENTITY:
+        # Using Managed Identity (passwordless)
+        blob_url = settings.STORAGE_ACCOUNT_URL
+        logger.info("🔐 Using Managed Identity to access storage: %s", blob_url)
+        BLOB_SERVICE = BlobServiceClient(
+            account_url=blob_url, credential=async_credential, **BLOB_CLIENT_OPTIONS
+        )
+    else:
+        # Using Connection String (with secrets)
+        connection_string = settings.STORAGE_CONNECTION_STRING
+        logger.info("🔑 Using Connection String to access storage")
+        BLOB_SERVICE = BlobServiceClient.from_connection_string(
+            connection_string, **BLOB_CLIENT_OPTIONS
+        )
+
+    # Fire-and-forget warmup so the first /ask doesn't pay for the blob
+    # download and token acquisition
+    _spawn(_warmup())
+
+async def _warm_token():
+    # Fetch the first AAD token up front so the first request doesn't wait
+    # on Entra ID; all deployments share the same token
+    if ASYNC_TOKEN_PROVIDER is not None:
+        await ASYNC_TOKEN_PROVIDER()
+
+async def _warmup():
+    try:
+        await asyncio.gather(get_context_from_blob(), _warm_token())
+        logger.info("✅ Warmup complete: context cached and credentials ready")
+    except Exception:
+        logger.warning("⚠️ Warmup failed, first request will retry", exc_info=True)
+
+@app.on_event("shutdown")
+async def close_blob_service():
+    if BLOB_SERVICE is not None:
+        await BLOB_SERVICE.close()
+    if async_credential is not None:
+        await async_credential.close()
+
+# Context cache: knowledge.txt is static between uploads, so keep the decoded
+# text in-process and only re-check the blob (via ETag) once the TTL expires.
+_ctx_cache = {"text": None, "etag": None, "ts": 0.0}
+_ctx_lock = asyncio.Lock()
+
+def _context_is_fresh():
+    return (
+        _ctx_cache["text"] is not None
+        and time.monotonic() - _ctx_cache["ts"] < settings.CONTEXT_CACHE_TTL_SECONDS
+    )
+
+class _PreallocatedWriter:
+    """Seekable write-only file over a fixed-size bytearray.
+
+    Parallel chunk downloads seek to each chunk's offset before writing, so
+    the target only needs seek/tell/write on top of a preallocated buffer.
+    """
+
+    def __init__(self, size):
+        self.data = bytearray(size)
+        self._view = memoryview(self.data)
+        self._pos = 0
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self._pos
+
+    def seek(self, offset, whence=os.SEEK_SET):
+        if whence == os.SEEK_CUR:
+            offset += self._pos
+        elif whence == os.SEEK_END:
+            offset += len(self.data)
+        self._pos = offset
+        return self._pos
+
+    def write(self, chunk):
+        end = self._pos + len(chunk)
+        self._view[self._pos:end] = chunk
+        self._pos = end
+        return len(chunk)
+
+def _serve_stale_context():
+    """Keeps answering from the cached text when a re-validation fails.
+
+    Must be called from an ``except`` block; with nothing cached yet the
+    error is re-raised. The timestamp is reset so the next attempt waits a
+    full TTL instead of every request retrying the failing download.
+    """
+    if _ctx_cache["text"] is None:
+        raise
+    logger.warning("⚠️ Could not re-validate blob, serving cached content", exc_info=True)
+    _ctx_cache["ts"] = time.monotonic()
+    return _ctx_cache["text"], _ctx_cache["etag"]
+
+async def get_context_from_blob():
+    """Fetches private data from Azure Blob with or without managed identity.
+
+    Returns a ``(text, etag)`` tuple. The decoded text is cached for
+    CONTEXT_CACHE_TTL_SECONDS; after that a conditional GET (If-None-Match)
+    only re-downloads the blob if it changed.
+    """
+    if _context_is_fresh():
+        return _ctx_cache["text"], _ctx_cache["etag"]
+
+    # Concurrent requests collapse onto a single refresh
+    async with _ctx_lock:
+        if _context_is_fresh():
+            return _ctx_cache["text"], _ctx_cache["etag"]
+
+        logger.debug("📂 Accessing container: '%s', blob: '%s'", CONTAINER_NAME, BLOB_NAME)
+        blob_client = BLOB_SERVICE.get_blob_client(CONTAINER_NAME, BLOB_NAME)
+        
+        try:
+            if _ctx_cache["etag"]:
+                logger.debug("⬇️ Re-validating blob content (ETag: %s)...", _ctx_cache["etag"])
+                downloader = await blob_client.download_blob(
+                    max_concurrency=BLOB_DOWNLOAD_CONCURRENCY,
+                    etag=_ctx_cache["etag"],
+                    match_condition=MatchConditions.IfModified
+                )
+            else:
+                logger.debug("⬇️ Downloading blob content...")
+                downloader = await blob_client.download_blob(
+                    max_concurrency=BLOB_DOWNLOAD_CONCURRENCY
+                )
+
+            # Stream straight into a buffer of the known size instead of
+            # readall(), which collects chunks in a BytesIO and copies them out
+            buffer = _PreallocatedWriter(downloader.size)
+            await downloader.readinto(buffer)
+        except HttpResponseError as exc:
+            # The SDK surfaces a 304 as a plain HttpResponseError, not as
+            # ResourceNotModifiedError
+            if exc.status_code != 304:
+                return _serve_stale_context()
+            logger.debug("✅ Blob not modified, reusing cached content")
+            _ctx_cache["ts"] = time.monotonic()
+            return _ctx_cache["text"], _ctx_cache["etag"]
+        except Exception:
+            return _serve_stale_context()
+
+        blob_data = buffer.data.decode('utf-8')
+        logger.info("✅ Successfully downloaded blob. Size: %d characters", len(blob_data))
+        logger.debug("📄 Blob content preview: %.200s...", blob_data)
+
+        etag = downloader.properties.etag
+        _ctx_cache.update(text=blob_data, etag=etag, ts=time.monotonic())
+        # Indexing can take a while for large files, so it runs in the
+        # background; until it finishes the whole context is sent
+        _spawn(_refresh_retrieval_index(blob_data, etag))
+        return blob_data, etag
+
+# Retrieval: with an embeddings deployment configured, knowledge.txt is
+# tokenized once per ETag. Small files are sent whole (which keeps the prompt
+# prefix cacheable); once a file grows past RETRIEVAL_MIN_TOKENS it is split
+# into chunks and indexed so each question only carries its top-k chunks.
+_tokenizer = {"encoding": None, "splitter": None}
+_retrieval_index = {"etag": None, "store": None}
+
+def _load_tokenizer():
+    # Loaded on first use only: tiktoken downloads the encoding file the first
+    # time, which must not be a requirement for importing the app
+    if _tokenizer["encoding"] is None:
+        _tokenizer["encoding"] = tiktoken.get_encoding("o200k_base")
+        _tokenizer["splitter"] = RecursiveCharacterTextSplitter.from_tiktoken_encoder(
+            encoding_name="o200k_base", chunk_size=512, chunk_overlap=64
+        )
+    return _tokenizer["encoding"], _tokenizer["splitter"]
+
+async def _build_retrieval_index(text):
+    store = None
+    if EMBEDDINGS is not None:
+        # Loading the encoding and tokenizing a large file are blocking, keep
+        # them off the event loop
+        encoding, splitter = await asyncio.to_thread(_load_tokenizer)
+        token_count = len(await asyncio.to_thread(encoding.encode, text))
+        logger.info("🔢 Context is %d tokens", token_count)
+
+        if token_count > settings.RETRIEVAL_MIN_TOKENS:
+            chunks = await asyncio.to_thread(splitter.split_text, text)
+            store = InMemoryVectorStore(EMBEDDINGS)
+            await store.aadd_texts(chunks)
+            logger.info("✅ Indexed %d context chunks for retrieval", len(chunks))
+    return store
+
+async def _refresh_retrieval_index(text, etag):
+    try:
+        store = await _build_retrieval_index(text)
+    except Exception:
+        logger.warning("⚠️ Building the retrieval index failed, sending the whole context", exc_info=True)
+        store = None
+    # A newer knowledge.txt may have been loaded while this one was indexing
+    if _ctx_cache["etag"] != etag:
+        return
+    _retrieval_index.update(etag=etag, store=store)
+    # Priming only helps when the whole context is sent as the prefix
+    if settings.PRIME_PROMPT_CACHE and store is None:
+        await _prime_prompt_cache(text)
+
+async def _select_context(context, etag, question):
+    """Returns the part of the context worth sending for this question."""
+    store = _retrieval_index["store"]
+    if store is None or _retrieval_index["etag"] != etag:
+        return context
+    try:
+        docs = await store.asimilarity_search(question, k=settings.RETRIEVAL_TOP_K)
+    except Exception:
+        logger.warning("⚠️ Retrieval failed, sending the whole context", exc_info=True)
+        return context
+    return "\n\n".join(doc.page_content for doc in docs)
+
+# Response cache: exact-match LRU keyed by (context ETag, question), so entries
+# stop matching as soon as a new knowledge.txt is uploaded
+_response_cache = OrderedDict()
+
+def _response_cache_key(etag, question):
+    return hashlib.sha256(f"{etag}|{question}".encode("utf-8")).hexdigest()
+
+def _response_cache_get(key):
+    answer = _response_cache.get(key)
+    if answer is not None:
+        _response_cache.move_to_end(key)
+    return answer
+
+def _response_cache_put(key, answer):
+    if settings.RESPONSE_CACHE_SIZE <= 0:
+        return
+    _response_cache[key] = answer
+    _response_cache.move_to_end(key)
+    while len(_response_cache) > settings.RESPONSE_CACHE_SIZE:
+        _response_cache.popitem(last=False)
+
+# Retry rate limits (429), 5xx, timeouts and connection errors with
+# exponential backoff instead of surfacing them to the client as 500s; this
+# covers what the disabled SDK retries would have. Each attempt picks a
+# deployment afresh, so a retry can fail over to the other one, and a call
+# waiting out its backoff doesn't hold a concurrency slot.
+_retry_transient = retry(
+    retry=retry_if_exception_type(
+        (RateLimitError, APIConnectionError, APITimeoutError, InternalServerError)
+    ),
+    stop=stop_after_attempt(3),
+    wait=wait_exponential(multiplier=1, max=30),
+    reraise=True,
+)
+
+async def _ainvoke_on_backend(backend, inputs):
+    async with backend["semaphore"]:
+        return await backend["chain"].ainvoke(inputs)
+
+@_retry_transient
+async def _ainvoke_with_retry(inputs):
+    return await _ainvoke_on_backend(_next_backend(), inputs)
+
+@_retry_transient
+async def _astream_with_retry(inputs):
+    """Opens a stream and waits for its first non-empty chunk.
+
+    Nothing has been sent to the client yet, so failures up to this point can
+    still be retried (or returned as a proper error status). Returns
+    ``(semaphore, stream, first_chunk)``; the caller owns the semaphore slot
+    and must release it once the stream is finished.
+    """
+    backend = _next_backend()
+    semaphore = backend["semaphore"]
+    stream = backend["chain"].astream(inputs)
+    await semaphore.acquire()
+    try:
+        async for chunk in stream:
+            if chunk:
+                return semaphore, stream, chunk
+        return semaphore, stream, ""
+    except BaseException:
+        semaphore.release()
+        await stream.aclose()
+        raise
+
+# Azure OpenAI has no API for uploading a reusable KV-cache handle, so the
+# closest we get to cache-augmented generation is priming its automatic prefix
+# cache: whenever a new knowledge.txt is loaded, send one throwaway request
+# with the same system prefix so real questions start on a warm cache.
+async def _prime_prompt_cache(context):
+    try:
+        # Prefix caches are per deployment, so each one is primed without
+        # failover, but under the same concurrency cap and retry policy as
+        # real questions
+        inputs = {"context": context, "question": "Reply with OK."}
+        await asyncio.gather(*(
+            _retry_transient(_ainvoke_on_backend)(backend, inputs)
+            for backend in LLM_BACKENDS
+        ))
+        logger.info("✅ Azure OpenAI prompt cache primed for the current context")
+    except Exception:
+        logger.warning("⚠️ Prompt cache priming failed", exc_info=True)
+
+def _log_prompt(context, question):
+    """Logs the complete prompt when DEBUG is on or the request is sampled.
+
+    The chain renders the template itself, so rendering it here is a second
+    full copy of the context; skip it unless someone will read the output.
+    """
+    if logger.isEnabledFor(logging.DEBUG):
+        level = logging.DEBUG
+    elif (
+        settings.PROMPT_AUDIT_SAMPLE_RATE > 0
+        and random.random() < settings.PROMPT_AUDIT_SAMPLE_RATE
+    ):
+        level = logging.INFO
+    else:
+        return
+
+    formatted_prompt = PROMPT.format(context=context, question=question)
+    logger.log(level, "=" * 80)
+    logger.log(level, "📤 COMPLETE PROMPT BEING SENT TO AZURE OPENAI:")
+    logger.log(level, "=" * 80)
+    logger.log(level, formatted_prompt)
+    logger.log(level, "=" * 80)
+
+# Single-flight: identical questions that arrive while an answer is still
+# being generated wait on the same task instead of calling the LLM again
+_inflight = {}
+
+async def _generate_answer(context, etag, question, cache_key):
+    context = await _select_context(context, etag, question)
+    _log_prompt(context, question)
+    logger.debug("🚀 Sending request to Azure OpenAI...")
+    answer = await _ainvoke_with_retry({"context": context, "question": question})
+    logger.debug("✅ Received response from Azure OpenAI. Answer length: %d characters", len(answer))
+    logger.debug("📄 Answer preview: %.200s...", answer)
+    _response_cache_put(cache_key, answer)
+    return answer
+
+def _finish_inflight(cache_key, task):
+    _inflight.pop(cache_key, None)
+    # Retrieve the exception here: if every waiter was cancelled nobody else
+    # reads it, and asyncio would report it as never retrieved
+    if not task.cancelled() and task.exception() is not None:
+        logger.warning("⚠️ Azure OpenAI call failed", exc_info=task.exception())
+
+async def _answer_question(context, etag, question):
+    """Answers one question from the response cache or Azure OpenAI."""
+    cache_key = _response_cache_key(etag, question)
+    answer = _response_cache_get(cache_key)
+    if answer is not None:
+        logger.debug("⚡ Response cache hit, skipping Azure OpenAI call")
+        return answer
+
+    task = _inflight.get(cache_key)
+    if task is None:
+        task = asyncio.create_task(_generate_answer(context, etag, question, cache_key))
+        _inflight[cache_key] = task
+        task.add_done_callback(lambda t: _finish_inflight(cache_key, t))
+    else:
+        logger.debug("🔗 Same question already in flight, waiting for its answer")
+    # Shielded so one client disconnecting doesn't cancel the call for the rest
+    return await asyncio.shield(task)
+
+@app.get("/ask")
+async def ask_langchain(question: str):
+    logger.debug("🎯 Received question: '%s'", question)
+
+    # 4. The RAG Chain
+    logger.debug("🔄 Fetching context from blob storage and preparing LLM...")
+    context, etag = await get_context_from_blob()
+    logger.debug("✅ Context retrieved. Length: %d characters", len(context))
+
+    # 5. Execute
+    answer = await _answer_question(context, etag, question)
     
-    response = {"answer": answer, "engine": f"LangChain + {auth_method}"}
-    logger.info("✅ Request completed successfully")
+    response = {"answer": answer, "engine": f"LangChain + {AUTH_METHOD}"}
+    logger.debug("✅ Request completed successfully")
     
-    return response
\ No newline at end of file
+    return response
+
+class BatchRequest(BaseModel):
+    questions: list[str] = Field(min_length=1, max_length=100)
+
+@app.post("/ask_batch")
+async def ask_langchain_batch(batch: BatchRequest):
+    """Answers several questions in one round-trip, fanning out concurrently."""
+    logger.debug("🎯 Received batch of %d questions", len(batch.questions))
+
+    context, etag = await get_context_from_blob()
+    semaphore = asyncio.Semaphore(settings.BATCH_CONCURRENCY)
+
+    async def answer_one(question):
+        async with semaphore:
+            return await _answer_question(context, etag, question)
+
+    # One failed question shouldn't throw away the answers already generated
+    answers = await asyncio.gather(
+        *(answer_one(q) for q in batch.questions), return_exceptions=True
+    )
+
+    results = []
+    for question, answer in zip(batch.questions, answers):
+        if isinstance(answer, Exception):
+            # The failure was already logged with its traceback when the
+            # in-flight call finished; only the error type goes to the client
+            results.append(
+                {"question": question, "answer": None, "error": type(answer).__name__}
+            )
+        else:
+            results.append({"question": question, "answer": answer})
+    logger.debug("✅ Batch completed")
+
+    return {"answers": results, "engine": f"LangChain + {AUTH_METHOD}"}
+
+# Stop proxies (e.g. nginx ingress) from buffering the stream
+_SSE_HEADERS = {"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+# Tells EventSource clients the answer is complete, so they close instead of
+# reconnecting and asking the same question again
+_SSE_DONE = "event: done\ndata: \n\n"
+
+def _sse_event(text):
+    # Multi-line chunks must be split into several "data:" fields
+    return "".join(f"data: {line}\n" for line in text.split("\n")) + "\n"
+
+@app.get("/ask_stream")
+async def ask_langchain_stream(question: str):
+    """Same as /ask, but streams the answer as Server-Sent Events token by token."""
+    logger.debug("🎯 Received streaming question: '%s'", question)
+
+    context, etag = await get_context_from_blob()
+    cache_key = _response_cache_key(etag, question)
+    cached_answer = _response_cache_get(cache_key)
+
+    if cached_answer is not None:
+        logger.debug("⚡ Response cache hit, skipping Azure OpenAI call")
+
+        async def event_stream():
+            yield _sse_event(cached_answer)
+            yield _SSE_DONE
+
+        return StreamingResponse(
+            event_stream(), media_type="text/event-stream", headers=_SSE_HEADERS
+        )
+
+    selected_context = await _select_context(context, etag, question)
+    _log_prompt(selected_context, question)
+    logger.debug("🚀 Streaming request to Azure OpenAI...")
+    # Wait for the first token before committing to a 200, so rate limits and
+    # other early failures are retried or surface as a real error response
+    semaphore, stream, first_chunk = await _astream_with_retry(
+        {"context": selected_context, "question": question}
+    )
+    closed = False
+
+    async def close_stream():
+        nonlocal closed
+        if not closed:
+            closed = True
+            semaphore.release()
+            await stream.aclose()
+
+    async def event_stream():
+        parts = [first_chunk]
+        try:
+            if first_chunk:
+                yield _sse_event(first_chunk)
+            # No retry from here on: a partially sent stream can't be replayed
+            async for chunk in stream:
+                # Skip the empty role/finish chunks
+                if not chunk:
+                    continue
+                parts.append(chunk)
+                yield _sse_event(chunk)
+        except Exception:
+            logger.warning("⚠️ Azure OpenAI stream failed mid-answer", exc_info=True)
+            yield "event: error\ndata: The answer stream was interrupted\n\n"
+            yield _SSE_DONE
+            return
+        finally:
+            await close_stream()
+
+        answer = "".join(parts)
+        logger.debug("✅ Finished streaming response. Answer length: %d characters", len(answer))
+        _response_cache_put(cache_key, answer)
+        yield _SSE_DONE
+
+    return StreamingResponse(
+        event_stream(),
+        media_type="text/event-stream",
+        headers=_SSE_HEADERS,
+        # Also releases the slot if the client leaves before streaming starts
+        background=BackgroundTask(close_stream),
+    )